@@ -1,17 +1,32 @@
 import streamlit as st
 import re
-import pandas as pd
-import os
 import json
-from io import StringIO, BytesIO
-from dotenv import load_dotenv
-from openai import AzureOpenAI
-import docx
-from docx import Document
-from docx.shared import Pt, Inches, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
-from docx.oxml import OxmlElement
+import time
+import hashlib
+import math
+import operator
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from sp_report import SUMMARY_HEADERS, create_word_document, create_markdown_report, summary_rows
+# openai is imported where it is used: Streamlit re-executes this script on every
+# interaction and it is only needed once the user acts
+
+# orjson parses the (often 10-50 KB) LLM responses several times faster; its
+# JSONDecodeError subclasses json.JSONDecodeError, so error handling is shared.
+# _json_key serializes an analysis canonically (sorted keys, UTF-8 bytes) for cache keys.
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_key(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_key(obj):
+        return json.dumps(obj, sort_keys=True).encode("utf-8")
 
 # Set page configuration
 st.set_page_config(
@@ -20,266 +35,549 @@ st.set_page_config(
     layout="wide"
 )
 
-# Function to create a Word document from analysis
-def create_word_document(analysis):
-    # Create a new Document
-    doc = Document()
-
-    # Add title
-    title = doc.add_heading('SQL Stored Procedure Analysis Report', 0)
-    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
-
-    # Add procedure name
-    proc_name_heading = doc.add_heading('Stored Procedure Name:', level=1)
-    # Make the procedure name itself bold in its own paragraph
-    proc_name_para = doc.add_paragraph()
-    proc_name_para.add_run(analysis['procedure_name']).bold = True
-
-    # Add scope
-    doc.add_heading('Scope:', level=1)
-    doc.add_paragraph(analysis['scope'])
-
-    # Add optimization steps
-    doc.add_heading('Optimization Steps:', level=1)
-
-    for i, opt in enumerate(analysis["optimizations"], 1):
-        # Step heading
-        step_heading = doc.add_heading(f'Step {i}: {opt["type"]}', level=2)
-
-        # Existing Logic
-        doc.add_heading('Existing Logic:', level=3)
-        existing_code = doc.add_paragraph(opt["existing_logic"])
-        # existing_code.style = 'Code'  # <--- REMOVE THIS LINE
-
-        # Format code paragraph
-        existing_code_fmt = existing_code.paragraph_format
-        existing_code_fmt.left_indent = Inches(0.25)
-        existing_code_fmt.right_indent = Inches(0.25)
-        # Apply monospaced font to the runs within the paragraph
-        for run in existing_code.runs:
-            run.font.name = 'Courier New'
-            # Optional: Set font size for code
-            run.font.size = Pt(10)
-
-        # Optimized Logic
-        doc.add_heading('Optimized Logic:', level=3)
-        optimized_code = doc.add_paragraph(opt["optimized_logic"])
-        # optimized_code.style = 'Code' # <--- REMOVE THIS LINE
-
-        # Format code paragraph
-        optimized_code_fmt = optimized_code.paragraph_format
-        optimized_code_fmt.left_indent = Inches(0.25)
-        optimized_code_fmt.right_indent = Inches(0.25)
-        # Apply monospaced font to the runs within the paragraph
-        for run in optimized_code.runs:
-            run.font.name = 'Courier New'
-            # Optional: Set font size for code
-            run.font.size = Pt(10)
-
-        # Explanation
-        explanation_para = doc.add_paragraph()
-        explanation_text = explanation_para.add_run(opt["explanation"])
-        explanation_text.italic = True
-
-        # Add separator paragraph (using a paragraph border might be better visually)
-        # Consider adding a paragraph border instead of underscores for a cleaner look
-        separator = doc.add_paragraph()
-        # Example of adding a bottom border (uncomment if desired)
-        # p_border = OxmlElement('w:pBdr')
-        # bottom_border = OxmlElement('w:bottom')
-        # bottom_border.set(qn('w:val'), 'single')
-        # bottom_border.set(qn('w:sz'), '6') # size in 1/8ths of a point
-        # bottom_border.set(qn('w:space'), '1')
-        # bottom_border.set(qn('w:color'), 'auto')
-        # p_border.append(bottom_border)
-        # separator._p.get_or_add_pPr().append(p_border)
-        # Or keep the simple underscore line:
-        separator.add_run('_' * 40)
-
-
-    # Add summary table
-    doc.add_heading('Summary:', level=1)
-
-    # Create table data (ensure line_number is handled if missing)
-    table_data = []
-    for opt in analysis["optimizations"]:
-        table_data.append({
-            "Type of Change": opt.get("type", "N/A"),
-            "Line Number": opt.get("line_number", "N/A"), # Use .get for safety
-            "Original Code Snippet": opt.get("existing_logic", "")[:40] + "..." if len(opt.get("existing_logic", "")) > 40 else opt.get("existing_logic", ""),
-            "Optimized Code Snippet": opt.get("optimized_logic", "")[:40] + "..." if len(opt.get("optimized_logic", "")) > 40 else opt.get("optimized_logic", ""),
-            "Optimization Explanation": opt.get("explanation", "")
-        })
-
-    # Add table to document only if there's data
-    if table_data:
-        num_rows = 1 + len(table_data)
-        num_cols = 5
-        table = doc.add_table(rows=num_rows, cols=num_cols)
-        table.style = 'Table Grid' # Ensure 'Table Grid' style exists or use a known default
-
-        # Set header row
-        header_cells = table.rows[0].cells
-        headers = ['Type of Change', 'Line Number', 'Original Code Snippet', 'Optimized Code Snippet', 'Optimization Explanation']
-        for i, header_text in enumerate(headers):
-            cell = header_cells[i]
-            # Clear existing content (sometimes needed)
-            cell.text = ''
-            # Add text and format
-            p = cell.paragraphs[0]
-            run = p.add_run(header_text)
-            run.bold = True
-            p.alignment = WD_ALIGN_PARAGRAPH.CENTER # Center align header text
-
-        # Add data rows
-        for i, item in enumerate(table_data):
-            row_cells = table.rows[i+1].cells
-            row_cells[0].text = item['Type of Change']
-            row_cells[1].text = item['Line Number']
-            row_cells[2].text = item['Original Code Snippet']
-            row_cells[3].text = item['Optimized Code Snippet']
-            row_cells[4].text = item['Optimization Explanation']
-
-        # Set table column widths (apply carefully)
-        try:
-            table.columns[0].width = Inches(1.2)
-            table.columns[1].width = Inches(0.8) # Reduced width for line number
-            table.columns[2].width = Inches(1.5)
-            table.columns[3].width = Inches(1.5)
-            table.columns[4].width = Inches(2.0) # Increased width for explanation
-        except IndexError:
-             st.warning("Could not set all table column widths.")
-
-
-        # Apply alternate row shading
-        for i, row in enumerate(table.rows):
-            if i > 0 and i % 2 == 0:  # Even data rows (index 2, 4, ...) get shading
-                for cell in row.cells:
-                    tcPr = cell._tc.get_or_add_tcPr()
-                    shading_elm = OxmlElement('w:shd')
-                    shading_elm.set(qn('w:fill'), "F2F2F2") # Light gray color
-                    shading_elm.set(qn('w:val'), 'clear') # Ensure fill type is set
-                    shading_elm.set(qn('w:color'), 'auto')
-                    tcPr.append(shading_elm)
-    else:
-        doc.add_paragraph("No optimization suggestions were generated.")
+# Serialized Word report, shared across sessions and keyed only by the analysis hash, so
+# the same analysis (e.g. the sample, or a cached re-analysis) is rendered once.
+# The leading underscore keeps Streamlit from hashing the analysis dict itself.
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_docx_bytes(analysis_hash, _analysis):
+    with create_word_document(_analysis) as report:
+        return report.read()
 
+# Markdown report bytes, cached the same way
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_markdown_bytes(analysis_hash, _analysis):
+    return create_markdown_report(_analysis).encode("utf-8")
 
-    # Save the document to a BytesIO object
-    doc_io = BytesIO()
-    doc.save(doc_io)
-    doc_io.seek(0)
+# --- Keep the rest of your Streamlit code as is ---
 
-    return doc_io
+# JSON schema for the analysis response, enforced server-side via structured outputs
+# (strict mode requires every property to be listed as required)
+_OPTIMIZATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "type": {"type": "string"},
+        "line_number": {"type": "string"},
+        "existing_logic": {"type": "string"},
+        "optimized_logic": {"type": "string"},
+        "explanation": {"type": "string"}
+    },
+    "required": ["type", "line_number", "existing_logic", "optimized_logic", "explanation"],
+    "additionalProperties": False
+}
+_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "procedure_name": {"type": "string"},
+        "scope": {"type": "string"},
+        "optimizations": {"type": "array", "items": _OPTIMIZATION_SCHEMA},
+        "summary": {
+            "type": "object",
+            "properties": {
+                "original_performance_issues": {"type": "string"},
+                "optimization_impact": {"type": "string"},
+                "implementation_difficulty": {"type": "string"}
+            },
+            "required": ["original_performance_issues", "optimization_impact", "implementation_difficulty"],
+            "additionalProperties": False
+        }
+    },
+    "required": ["procedure_name", "scope", "optimizations", "summary"],
+    "additionalProperties": False
+}
+
+# Structured output: the service enforces the schema, so the prompt needs no JSON template
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "sp_analysis", "strict": True, "schema": _ANALYSIS_SCHEMA}
+}
+
+# Fixed instructions, sent as the system message with only the SQL in the user message.
+# Defined once so the prefix stays byte-identical across calls for prompt caching.
+_SYSTEM_PROMPT = """You are an expert SQL database optimizer.
+
+Analyze the SQL stored procedure supplied by the user, where every line is prefixed with
+its line number and "| ". A long procedure is sent in several parts; analyze only the
+lines you are given. Provide:
+1. The name of the stored procedure
+2. The scope/purpose of the stored procedure with details of 4-5 lines.
+3. High-priority optimization opportunities (up to 5), focusing on:
+   - Unused temp tables
+   - Cursors that can be replaced with CTEs
+   - Multiple UPDATE/DELETE statements that can be combined
+   - Poor indexing patterns
+   - Nested queries with performance issues
+   - Any other critical performance issues
+
+For each optimization opportunity, provide:
+- type: type of optimization
+- line_number: line number or range in the code (e.g. 12-30), using the line number prefixes
+- existing_logic: existing code snippet as complete lines of code without the line number prefixes
+  (include the full section of relevant code). If the section is longer than 20 lines, return an
+  empty string instead: it is copied from the file using line_number
+- optimized_logic: optimized code snippet (your suggestion) with full implementation details
+- explanation: brief explanation of the benefit
+
+Finally, summarize the key issues found, the estimated impact of the optimizations
+and how difficult they would be to implement."""
+
+# Compiled patterns, used by name below rather than through re.sub/re.search with a
+# pattern string. This page script re-runs on every interaction, so these lines do too;
+# re's internal cache makes the repeat compiles cheap lookups.
+# String literals and quoted identifiers are matched alongside comments so that
+# comment markers inside them are not mistaken for comments.
+_SQL_LITERAL_OR_COMMENT_RE = re.compile(r"N?'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\[[^\]\n]*\]|/\*.*?\*/|--[^\n]*", re.S)
+_WS_RE = re.compile(r'[ \t]+')
+_LINE_RANGE_RE = re.compile(r'(\d+)(?:\s*-\s*(\d+))?')
+# A numbered line holding only GO or END, where a long procedure is preferably split
+_CHUNK_BOUNDARY_RE = re.compile(r'\d+\| (?:GO|END);?$', re.IGNORECASE)
+
+# Shrink the SQL sent to the model: drop -- and /* */ comments (string literals and
+# quoted identifiers are left alone), collapse runs of spaces and tabs and skip blank
+# lines. line_map[i] is the original line number of minified line i + 1.
+def minify_sql(sql):
+    def strip_comment(match):
+        token = match.group()
+        if token.startswith('--'):
+            return ''
+        if token.startswith('/*'):
+            # Keep the line breaks so later lines keep their original numbers
+            return '\n' * token.count('\n') or ' '
+        return token
+
+    sql = sql.replace('\r\n', '\n').replace('\r', '\n')
+    sql = _SQL_LITERAL_OR_COMMENT_RE.sub(strip_comment, sql)
+
+    lines = []
+    line_map = []
+    for number, line in enumerate(sql.split('\n'), 1):
+        line = _WS_RE.sub(' ', line).strip()
+        if line:
+            lines.append(line)
+            line_map.append(number)
+    return '\n'.join(lines), line_map
+
+# Prefix each minified line with its line number in the original file, so the model
+# reports line numbers that need no remapping and can cite long sections by range
+def _number_lines(minified_sql, line_map):
+    return '\n'.join(f'{number}| {line}' for number, line in zip(line_map, minified_sql.split('\n')))
+
+# Numbered SQL sent per request, in characters (roughly 3-4k tokens)
+_CHUNK_MAX_CHARS = 12000
+
+# Split numbered SQL into parts of at most _CHUNK_MAX_CHARS, cutting after the last GO or
+# END line that fits (or at any line when there is none). The line number prefixes keep
+# every part's line numbers relative to the whole file.
+def _split_prompt(numbered_sql):
+    if len(numbered_sql) <= _CHUNK_MAX_CHARS:
+        return [numbered_sql]
+
+    chunks = []
+    current = []
+    size = 0
+    boundary = 0
+    for line in numbered_sql.split('\n'):
+        while current and size + len(line) > _CHUNK_MAX_CHARS:
+            cut = boundary or len(current)
+            chunks.append('\n'.join(current[:cut]))
+            current = current[cut:]
+            size = sum(len(kept) + 1 for kept in current)
+            boundary = 0
+        current.append(line)
+        size += len(line) + 1
+        if _CHUNK_BOUNDARY_RE.match(line):
+            boundary = len(current)
+    chunks.append('\n'.join(current))
+    return chunks
+
+# The model leaves existing_logic empty for sections over 20 lines rather than echoing
+# them back token by token; copy those sections from the uploaded file instead
+def _fill_long_snippets(analysis_data, sql):
+    lines = None
+    for opt in analysis_data["optimizations"]:
+        if opt["existing_logic"].strip():
+            continue
+        match = _LINE_RANGE_RE.search(opt["line_number"])
+        if match is None:
+            continue
+        if lines is None:
+            lines = sql.replace('\r\n', '\n').split('\n')
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        opt["existing_logic"] = '\n'.join(lines[max(first, 1) - 1:last]).strip('\n')
+    return analysis_data
+
+# Combine the analyses of a procedure's parts: the name and scope come from the first part,
+# which holds the procedure header, and the optimizations are kept in file order
+def _merge_analyses(analyses):
+    merged = analyses[0]
+    for analysis in analyses[1:]:
+        merged["optimizations"].extend(analysis["optimizations"])
+    return merged
+
+# Messages for one analysis, shared by the streamed and batch calls. The SQL is the whole
+# user message, so nothing is formatted into the prompt and SQL braces need no escaping.
+def _analysis_messages(sql):
+    return [
+        {"role": "system", "content": _SYSTEM_PROMPT},
+        {"role": "user", "content": sql}
+    ]
+
+# Idle connections to Azure OpenAI: seconds each is kept open for reuse, and how many
+_KEEPALIVE_EXPIRY = 120
+_KEEPALIVE_CONNECTIONS = 100
+
+_REQUIRED_SECRETS = ("AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_API_KEY", "API_VERSION")
+
+# Check the Azure OpenAI secrets before any client is built, so the user is told every
+# missing or empty secret at once instead of a KeyError for the first one
+def _secrets_configured():
+    missing = []
+    for name in _REQUIRED_SECRETS:
+        try:
+            if not st.secrets[name]:
+                missing.append(name)
+        except (KeyError, FileNotFoundError):
+            missing.append(name)
+    if missing:
+        st.error(f"Missing required secrets: {', '.join(missing)}. Please check your .streamlit/secrets.toml file.")
+        return False
+    return True
+
+# Set DEBUG = true in secrets.toml to show the raw response and error tracebacks in the sidebar
+def _debug_enabled():
+    try:
+        return bool(st.secrets.get("DEBUG", False))
+    except FileNotFoundError:
+        return False
+
+# Azure OpenAI client, built once and reused across reruns so the connection pool stays warm
+@st.cache_resource(show_spinner=False)
+def _get_client():
+    import httpx2
+    from openai import AzureOpenAI, DefaultHttpxClient
+
+    # Idle connections are kept open for longer, so reusing the TLS connection saves the
+    # handshake on every analysis. This client is shared by every session: the total is
+    # left uncapped, so one user's requests never queue behind another's, and the idle
+    # pool keeps the SDK's default of 100 connections so concurrent users all stay warm.
+    http_client = DefaultHttpxClient(
+        limits=httpx2.Limits(max_keepalive_connections=_KEEPALIVE_CONNECTIONS, keepalive_expiry=_KEEPALIVE_EXPIRY)
+    )
+    return AzureOpenAI(
+        api_key=st.secrets["AZURE_OPENAI_API_KEY"],
+        api_version=st.secrets["API_VERSION"],
+        azure_endpoint=st.secrets["AZURE_OPENAI_ENDPOINT"],
+        http_client=http_client
+    )
+
+# Bump when the prompt or schema changes so cached analyses from the old prompt are not reused
+_PROMPT_VERSION = "v4"
+
+# Parsed analyses, shared by all sessions and keyed on the SQL hash, so re-analyzing the
+# same procedure skips both the round-trip and the JSON parse. Held in a cache_resource
+# rather than st.cache_data because the call streams into the page, which a cached
+# function cannot replay. Sessions run on their own threads, so every access goes through
+# the lock kept with the cache.
+_ANALYSIS_CACHE_TTL = 86400
+_ANALYSIS_CACHE_MAX_ENTRIES = 128
+
+@st.cache_resource
+def _analysis_cache():
+    return OrderedDict(), threading.Lock()
+
+def _analysis_cache_key(file_content, deployment_name):
+    # Line endings and trailing whitespace do not change the analysis
+    normalized = "\n".join(line.rstrip() for line in file_content.splitlines()).rstrip("\n")
+    return (hashlib.sha256(normalized.encode("utf-8")).hexdigest(), deployment_name, _PROMPT_VERSION)
+
+def _get_cached_analysis(key):
+    cache, lock = _analysis_cache()
+    with lock:
+        entry = cache.get(key)
+        if entry is None or time.monotonic() - entry[0] > _ANALYSIS_CACHE_TTL:
+            return None
+        cache.move_to_end(key)
+    return entry[1]
+
+def _put_cached_analysis(key, value):
+    cache, lock = _analysis_cache()
+    with lock:
+        cache[key] = (time.monotonic(), value)
+        cache.move_to_end(key)
+        while len(cache) > _ANALYSIS_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+# Semantic cache: near-duplicate procedures (reformatted, comments changed, locals renamed)
+# reuse an earlier analysis from the same session when their embeddings are close enough.
+# Needs an embedding deployment (e.g. text-embedding-3-small) in AZURE_OPENAI_EMBEDDING_DEPLOYMENT.
+_SEMANTIC_CACHE_MIN_SIMILARITY = 0.92
+_SEMANTIC_CACHE_TTL = 86400
+_EMBEDDING_MAX_CHARS = 24000  # keeps the input under the embedding model's token limit
+
+def _embedding_deployment():
+    try:
+        return st.secrets.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+    except FileNotFoundError:
+        return None
 
-# --- Keep the rest of your Streamlit code as is ---
+# Embed the minified SQL on a single line; returns a unit vector
+def _embed_sql(minified_sql):
+    normalized = minified_sql.replace('\n', ' ')[:_EMBEDDING_MAX_CHARS]
+    response = _get_client().embeddings.create(model=_embedding_deployment(), input=normalized)
+    vector = response.data[0].embedding
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+def _find_similar_analysis(embedding):
+    now = time.time()
+    entries = [entry for entry in st.session_state.get('semantic_cache', []) if now - entry[0] <= _SEMANTIC_CACHE_TTL]
+    st.session_state['semantic_cache'] = entries
+    best_similarity, best_analysis = 0.0, None
+    for _, vector, analysis in entries:
+        similarity = sum(map(operator.mul, embedding, vector))
+        if similarity > best_similarity:
+            best_similarity, best_analysis = similarity, analysis
+    return best_analysis if best_similarity >= _SEMANTIC_CACHE_MIN_SIMILARITY else None
+
+def _remember_analysis(embedding, analysis):
+    st.session_state.setdefault('semantic_cache', []).append((time.time(), embedding, analysis))
+
+# Stream the Azure OpenAI completion, yielding text as it arrives
+def _stream_azure(file_content, deployment_name):
+    client = _get_client()
+
+    response = client.chat.completions.create(
+        model=deployment_name,
+        messages=_analysis_messages(file_content),
+        temperature=0.3,
+        response_format=_RESPONSE_FORMAT,
+        stream=True
+    )
+
+    refusal = []
+    finish_reason = None
+    streamed = False
+    for chunk in response:
+        # Azure sends content-filter chunks with no choices
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.delta.refusal:
+            refusal.append(choice.delta.refusal)
+        if choice.delta.content:
+            streamed = True
+            yield choice.delta.content
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+
+    if refusal or not streamed:
+        raise _empty_response_error("".join(refusal), finish_reason)
+
+# A strict-schema refusal or a content-filter stop comes back without content
+def _empty_response_error(refusal, finish_reason):
+    if refusal:
+        return RuntimeError(f"The model refused the analysis: {refusal}")
+    return RuntimeError(f"The model returned no analysis (finish reason: {finish_reason}).")
+
+# Seconds between live-preview repaints; each repaint ships the whole tail to the browser
+_LIVE_PREVIEW_INTERVAL = 0.15
+_LIVE_PREVIEW_CHARS = 2000
+
+# Worker threads for this session's completions. Kept per session so one user's 10-30 s
+# stream never queues behind other users'; the second worker lets a new analysis start
+# while an abandoned one (e.g. after a new upload) is still finishing.
+def _analysis_executor():
+    executor = st.session_state.get('analysis_executor')
+    if executor is None:
+        executor = st.session_state['analysis_executor'] = ThreadPoolExecutor(max_workers=2)
+    return executor
+
+# Runs on a worker thread: stream the completion, appending the pieces to parts, and return
+# the full response text of every part. The parts of a long procedure are requested
+# concurrently instead, each response landing in parts whole.
+def _stream_into(parts, chunks, deployment_name):
+    if len(chunks) == 1:
+        for piece in _stream_azure(chunks[0], deployment_name):
+            parts.append(piece)
+        return ["".join(parts)]
+
+    responses = asyncio.run(_analyze_all(dict(enumerate(chunks)), deployment_name, parts))
+    for response in responses.values():
+        if isinstance(response, Exception):
+            raise response
+    return list(responses.values())
+
+# Show the tail of the JSON in the placeholder as the worker streams it, until it is done
+def _follow_stream(parts, future, placeholder):
+    while not future.done():
+        placeholder.code("".join(parts)[-_LIVE_PREVIEW_CHARS:], language="json")
+        time.sleep(_LIVE_PREVIEW_INTERVAL)
+    responses = future.result()
+    placeholder.code("".join(parts)[-_LIVE_PREVIEW_CHARS:], language="json")
+    return responses
 
 # Function to analyze stored procedure using Azure OpenAI
-def analyze_stored_procedure(file_content):
+def analyze_stored_procedure(file_content, use_semantic_cache=False):
     try:
-        # Load credentials securely from Streamlit secrets
-        azure_openai_endpoint = st.secrets["AZURE_OPENAI_ENDPOINT"]
-        azure_openai_key = st.secrets["AZURE_OPENAI_API_KEY"]
-        azure_api_version = st.secrets["API_VERSION"]
-
-        # Validate credentials
-        if not all([azure_openai_endpoint, azure_openai_key, azure_api_version]):
-            st.error("Missing required secrets. Please check your .streamlit/secrets.toml file.")
+        if not _secrets_configured():
             return None
 
-        # Initialize Azure OpenAI client
-        client = AzureOpenAI(
-            api_key=azure_openai_key,
-            api_version=azure_api_version,
-            azure_endpoint=azure_openai_endpoint
-        )
-
         deployment_name = "gpt-4o-mini"
-        
-        prompt = f"""
-        Analyze the following SQL stored procedure and return your analysis in JSON format:
-        
-        {file_content}
-        
-        Extract and provide:
-        1. The name of the stored procedure
-        2. The scope/purpose of the stored procedure with details of 4-5 lines.
-        3. High-priority optimization opportunities (up to 5), focusing on:
-           - Unused temp tables
-           - Cursors that can be replaced with CTEs
-           - Multiple UPDATE/DELETE statements that can be combined
-           - Poor indexing patterns
-           - Nested queries with performance issues
-           - Any other critical performance issues
-        
-        For each optimization opportunity, provide:
-        - Type of optimization
-        - Line number or location in code
-        - Existing code snippet as complete line of code (include the full section of relevant code)
-        - Optimized code snippet (your suggestion) with full implementation details
-        - Brief explanation of the benefit
-        
-        Structure your response as valid JSON that matches this format exactly:
-        ```json
-        {{
-            "procedure_name": "name_here",
-            "scope": "description_here",
-            "optimizations": [
-                {{
-                    "type": "type of optimization",
-                    "line_number": "approximate line number or range",
-                    "existing_logic": "current code snippet with complete context",
-                    "optimized_logic": "complete improved code snippet with all necessary implementation details",
-                    "explanation": "brief explanation of benefits and performance improvements"
-                }}
-            ],
-            "summary": {{
-                "original_performance_issues": "brief overview of key issues found in the original procedure",
-                "optimization_impact": "estimated impact of all recommended optimizations",
-                "implementation_difficulty": "assessment of how challenging these changes would be to implement"
-            }}
-        }}
-        ```
-        
-        Ensure your response is properly formatted JSON and nothing else.
-        """
 
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": "You are an expert SQL database optimizer that always returns responses in valid JSON format."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            response_format={"type": "json_object"}  # Explicitly request JSON response
-        )
-        
-        # Extract the JSON from the response
-        analysis_result = response.choices[0].message.content
-        st.write(analysis_result)
+        cache_key = _analysis_cache_key(file_content, deployment_name)
+        cached_analysis = _get_cached_analysis(cache_key)
+        if cached_analysis is not None:
+            return cached_analysis
+
+        # The completion streams on a worker thread and is kept in the session, so a rerun
+        # triggered by another widget picks the same request back up instead of losing it.
+        # A resumed job skips the minify and the (paid) embedding request; its embedding is
+        # kept with the job.
+        job = st.session_state.get('analysis_job')
+        if job is None or job[0] != cache_key:
+            minified_sql, line_map = minify_sql(file_content)
+            prompt_sql = _number_lines(minified_sql, line_map)
+
+            embedding = None
+            if use_semantic_cache:
+                try:
+                    embedding = _embed_sql(minified_sql)
+                except Exception as e:
+                    st.warning(f"Semantic cache unavailable: {str(e)}")
+                if embedding is not None:
+                    similar_analysis = _find_similar_analysis(embedding)
+                    if similar_analysis is not None:
+                        st.info("Reusing the analysis of a near-identical procedure: its line numbers and code snippets are from that file. Untick 'Use semantic cache' to force a fresh analysis.")
+                        return similar_analysis
+
+            parts = []
+            job = (cache_key, parts, _analysis_executor().submit(_stream_into, parts, _split_prompt(prompt_sql), deployment_name), embedding)
+            st.session_state['analysis_job'] = job
+        _, parts, future, embedding = job
+
+        # Paint tokens as they arrive instead of waiting for the full completion
+        with st.status("Analyzing…", expanded=True) as status:
+            try:
+                responses = _follow_stream(parts, future, st.empty())
+            finally:
+                if future.done():
+                    st.session_state.pop('analysis_job', None)
+            status.update(label="Analysis complete", state="complete", expanded=False)
         
         # Debug: Display raw response for troubleshooting
-        st.sidebar.expander("Debug Raw Response", expanded=False).code(analysis_result)
+        if _debug_enabled():
+            st.sidebar.expander("Debug Raw Response", expanded=False).code("\n\n".join(responses))
         
-        # Clean the response: Remove any markdown formatting if present
-        cleaned_response = analysis_result.strip()
-        if cleaned_response.startswith("```json"):
-            cleaned_response = cleaned_response[7:]  # Remove ```json prefix
-        if cleaned_response.endswith("```"):
-            cleaned_response = cleaned_response[:-3]  # Remove ``` suffix
-            
-        # Parse the JSON
+        # Parse the JSON; structured outputs return it bare, never inside a markdown fence
         try:
-            return json.loads(cleaned_response)
+            analysis_data = _merge_analyses([_json_loads(response) for response in responses])
         except json.JSONDecodeError as e:
             st.error(f"Failed to parse JSON response: {str(e)}")
-            st.code(cleaned_response)  # Show the problematic response
+            st.code("\n\n".join(responses))  # Show the problematic response
             return None
+
+        # The schema is enforced server-side, so a response that parses has every field;
+        # only a stream cut short (token limit, dropped connection) can fail above
+        _fill_long_snippets(analysis_data, file_content)
+
+        _put_cached_analysis(cache_key, analysis_data)
+        if embedding is not None:
+            _remember_analysis(embedding, analysis_data)
+        return analysis_data
     
     except Exception as e:
         st.error(f"Error during analysis: {str(e)}")
-        import traceback
-        st.sidebar.expander("Error Details", expanded=False).code(traceback.format_exc())
+        if _debug_enabled():
+            import traceback
+            st.sidebar.expander("Error Details", expanded=False).code(traceback.format_exc())
+        return None
+
+# Concurrent requests per batch, kept low to stay under the deployment's rate limit
+_BATCH_CONCURRENCY = 5
+
+async def _analyze_one(client, semaphore, file_content, deployment_name, parts):
+    async with semaphore:
+        response = await client.chat.completions.create(
+            model=deployment_name,
+            messages=_analysis_messages(file_content),
+            temperature=0.3,
+            response_format=_RESPONSE_FORMAT
+        )
+    choice = response.choices[0]
+    if choice.message.refusal or choice.message.content is None:
+        raise _empty_response_error(choice.message.refusal, choice.finish_reason)
+    if parts is not None:
+        parts.append(choice.message.content)
+    return choice.message.content
+
+# One async client per batch: it is bound to the event loop that asyncio.run creates.
+# Returns {key: response text or exception} for the {key: SQL} prompts; each response is
+# also appended to parts, when given, as soon as it arrives.
+async def _analyze_all(prompts, deployment_name, parts=None):
+    from openai import AsyncAzureOpenAI
+
+    semaphore = asyncio.Semaphore(_BATCH_CONCURRENCY)
+    async with AsyncAzureOpenAI(
+        api_key=st.secrets["AZURE_OPENAI_API_KEY"],
+        api_version=st.secrets["API_VERSION"],
+        azure_endpoint=st.secrets["AZURE_OPENAI_ENDPOINT"]
+    ) as client:
+        results = await asyncio.gather(
+            *(_analyze_one(client, semaphore, sql, deployment_name, parts) for sql in prompts.values()),
+            return_exceptions=True
+        )
+    return dict(zip(prompts, results))
+
+# Analyze several procedures concurrently; returns {file name: analysis} for the ones that succeeded
+def analyze_stored_procedures(sql_by_name):
+    try:
+        if not _secrets_configured():
+            return None
+
+        deployment_name = "gpt-4o-mini"
+
+        analyses = {}
+        pending = {}
+        for name, file_content in sql_by_name.items():
+            cache_key = _analysis_cache_key(file_content, deployment_name)
+            cached_analysis = _get_cached_analysis(cache_key)
+            if cached_analysis is not None:
+                analyses[name] = cached_analysis
+            else:
+                pending[name] = file_content
+
+        if pending:
+            # Every part of every file goes into the same concurrent batch
+            prompts = {
+                (name, i): chunk
+                for name, file_content in pending.items()
+                for i, chunk in enumerate(_split_prompt(_number_lines(*minify_sql(file_content))))
+            }
+            responses = {}
+            for (name, _), response in asyncio.run(_analyze_all(prompts, deployment_name)).items():
+                responses.setdefault(name, []).append(response)
+            for name, file_responses in responses.items():
+                error = next((response for response in file_responses if isinstance(response, Exception)), None)
+                if error is not None:
+                    st.error(f"{name}: Error during analysis: {str(error)}")
+                    continue
+                try:
+                    analysis_data = _merge_analyses([_json_loads(response) for response in file_responses])
+                except json.JSONDecodeError as e:
+                    st.error(f"{name}: Failed to parse JSON response: {str(e)}")
+                    continue
+                _fill_long_snippets(analysis_data, pending[name])
+                _put_cached_analysis(_analysis_cache_key(pending[name], deployment_name), analysis_data)
+                analyses[name] = analysis_data
+
+        # Keep upload order for the result tabs
+        return {name: analyses[name] for name in sql_by_name if name in analyses}
+
+    except Exception as e:
+        st.error(f"Error during analysis: {str(e)}")
+        if _debug_enabled():
+            import traceback
+            st.sidebar.expander("Error Details", expanded=False).code(traceback.format_exc())
         return None
 
 # UI Components
@@ -335,9 +633,9 @@ st.markdown("""
     - Download formatted report as Word document
     """)
 
-# Sample SQL button for testing
-if st.button("Load Sample SQL for Testing"):
-    sample_sql = """
+# Sample procedure for testing
+def _sample_sql():
+    return """
     CREATE PROCEDURE usp_GetCustomerOrders
     @CustomerId INT
     AS
@@ -404,159 +702,168 @@ if st.button("Load Sample SQL for Testing"):
         DROP TABLE #TempOrders
     END
     """
-    st.session_state['sample_sql'] = sample_sql
+
+# Sample SQL button for testing
+if st.button("Load Sample SQL for Testing"):
+    st.session_state['sample_sql'] = True
+    st.session_state.pop('analysis', None)
+    st.session_state.pop('analysis_job', None)
     st.success("Sample SQL loaded! Click 'Analyze' to process it.")
 
+# Flag an upload change so the file is only decoded when it actually changes
+def _on_sql_upload():
+    st.session_state['sql_changed'] = True
+    st.session_state.pop('analysis', None)
+    st.session_state.pop('analysis_job', None)
+    st.session_state.pop('batch', None)
+
+# Summary table columns: the code snippets get the wider columns
+_SUMMARY_COLUMN_CONFIG = {
+    "Original Code Snippet": st.column_config.TextColumn(width="medium"),
+    "Optimized Code Snippet": st.column_config.TextColumn(width="medium"),
+    "Optimization Explanation": st.column_config.TextColumn(width="medium")
+}
+
+def _render_optimizations(optimizations):
+    # Display optimization steps
+    st.subheader("🔹 Optimization Steps:")
+    
+    for i, opt in enumerate(optimizations, 1):
+        st.markdown(f"⚙️ **Step {i}**: {opt['type']}")
+        
+        st.markdown("**Existing Logic:**")
+        st.code(opt["existing_logic"], language="sql")
+        
+        st.markdown("**Optimized Logic:**")
+        st.code(opt["optimized_logic"], language="sql")
+        
+        st.markdown(f"*{opt['explanation']}*")
+        st.markdown("---")
+
+def _render_summary(optimizations):
+    # Create and display summary table
+    st.subheader("🔹 Summary:")
+    
+    # Passed column by column, the same rows the reports use; sent to the browser as
+    # Arrow rather than an HTML string the page re-parses
+    summary_data = dict(zip(SUMMARY_HEADERS, zip(*summary_rows(optimizations))))
+    st.dataframe(summary_data, hide_index=True, column_config=_SUMMARY_COLUMN_CONFIG)
+
+# Render one analysis with its report downloads; slot keeps widget keys apart when
+# several analyses are shown at once
+def _render_analysis(analysis, slot):
+    # Both reports are cached per analysis; the Word document is only built once its
+    # download button is clicked
+    report_key = hashlib.sha256(_json_key(analysis)).hexdigest()
+
+    # Display results in tabs
+    tab1, tab2 = st.tabs(["Analysis", "Download Report"])
+    
+    with tab1:
+        # Display the procedure name and scope
+        st.header(f"🔹 Stored Proc Name: `{analysis['procedure_name']}`")
+        
+        st.subheader("🔹 Scope:")
+        st.write(analysis["scope"])
+        
+        _render_optimizations(analysis["optimizations"])
+        _render_summary(analysis["optimizations"])
+
+    with tab2:
+        # Provide download button for DOCX; Streamlit calls data in a worker thread on click
+        st.download_button(
+            label="⬇️ Download Report as Word Document",
+            data=lambda: build_docx_bytes(report_key, analysis),
+            file_name=f"{analysis['procedure_name']}_analysis.docx",
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            key=f'docx-download-{slot}',
+            on_click="ignore"
+        )
+        
+        st.download_button(
+            label="⬇️ Download Report as Markdown",
+            data=build_markdown_bytes(report_key, analysis),
+            file_name=f"{analysis['procedure_name']}_analysis.md",
+            mime="text/markdown",
+            key=f'md-download-{slot}',
+            on_click="ignore"
+        )
+        
+        st.info("The Word document (.docx) contains the same content as shown in the 'Analysis' tab, but in a properly formatted document for sharing.")
+
 # File upload component
-uploaded_file = st.file_uploader("Upload SQL Stored Procedure", type=["sql"])
+uploaded_files = st.file_uploader(
+    "Upload SQL Stored Procedure", type=["sql"], accept_multiple_files=True, on_change=_on_sql_upload
+)
 
-# Get SQL either from upload or sample
+# Decode the uploads once per change; other reruns reuse the decoded text. Bad bytes
+# become U+FFFD instead of failing the whole file, and a UTF-8 BOM (as SSMS writes) is dropped.
+if st.session_state.pop('sql_changed', False) or (uploaded_files and 'uploaded_sql' not in st.session_state):
+    st.session_state['uploaded_sql'] = {f.name: f.getvalue().decode("utf-8-sig", errors="replace") for f in uploaded_files}
+    st.session_state['undecodable_sql'] = [name for name, sql in st.session_state['uploaded_sql'].items() if '\ufffd' in sql]
+
+if uploaded_files and st.session_state['undecodable_sql']:
+    st.warning(f"Some bytes were not valid UTF-8 and were replaced with '\ufffd': {', '.join(st.session_state['undecodable_sql'])}")
+
+# Get SQL either from upload or sample; several uploads are analyzed as a batch
 sql_content = None
-if uploaded_file:
-    sql_content = uploaded_file.getvalue().decode("utf-8")
-elif 'sample_sql' in st.session_state:
-    sql_content = st.session_state['sample_sql']
+sql_batch = None
+if uploaded_files:
+    uploaded_sql = st.session_state['uploaded_sql']
+    if len(uploaded_sql) == 1:
+        sql_content = next(iter(uploaded_sql.values()))
+    else:
+        sql_batch = uploaded_sql
+elif st.session_state.get('sample_sql'):
+    sql_content = _sample_sql()
     st.info("Using sample SQL procedure. You can upload your own file to replace it.")
 
-if sql_content:
+if sql_batch:
+    with st.expander(f"View SQL Code ({len(sql_batch)} files)", expanded=False):
+        for name, sql in sql_batch.items():
+            st.markdown(f"**{name}**")
+            st.code(sql, language="sql")
+
+    if st.button(f"Analyze {len(sql_batch)} SQL Procedures"):
+        with st.spinner(f"Analyzing {len(sql_batch)} stored procedures..."):
+            st.session_state['batch'] = analyze_stored_procedures(sql_batch)
+
+        if not st.session_state['batch']:
+            st.error("Analysis could not be completed. Set DEBUG = true in .streamlit/secrets.toml to see the details in the sidebar.")
+
+    batch = st.session_state.get('batch')
+    if batch:
+        for file_tab, (name, analysis) in zip(st.tabs(list(batch)), batch.items()):
+            with file_tab:
+                _render_analysis(analysis, name)
+
+elif sql_content:
     # Display the SQL
     with st.expander("View SQL Code", expanded=False):
         st.code(sql_content, language="sql")
     
-    # Analysis button
-    if st.button("Analyze SQL Procedure"):
+    # Semantic cache toggle, offered only when an embedding deployment is configured
+    use_semantic_cache = False
+    if _embedding_deployment():
+        use_semantic_cache = st.checkbox(
+            "Use semantic cache",
+            value=False,
+            help="Reuse the analysis of a near-identical procedure analyzed earlier in this session."
+        )
+
+    # Analysis button; an analysis still streaming from an interrupted run is resumed too
+    if st.button("Analyze SQL Procedure") or 'analysis_job' in st.session_state:
         # Run analysis
         with st.spinner("Analyzing stored procedure... This may take up to 30 seconds."):
-            analysis = analyze_stored_procedure(sql_content)
+            st.session_state['analysis'] = analyze_stored_procedure(sql_content, use_semantic_cache)
         
-        if analysis:
-            # Display results in tabs
-            tab1, tab2 = st.tabs(["Analysis", "Download Report"])
-            
-            with tab1:
-                # Display the procedure name and scope
-                st.header(f"🔹 Stored Proc Name: `{analysis['procedure_name']}`")
-                
-                st.subheader("🔹 Scope:")
-                st.write(analysis["scope"])
-                
-                # Display optimization steps
-                st.subheader("🔹 Optimization Steps:")
-                
-                for i, opt in enumerate(analysis["optimizations"], 1):
-                    st.markdown(f"⚙️ **Step {i}**: {opt['type']}")
-                    
-                    st.markdown("**Existing Logic:**")
-                    st.code(opt["existing_logic"], language="sql")
-                    
-                    st.markdown("**Optimized Logic:**")
-                    st.code(opt["optimized_logic"], language="sql")
-                    
-                    st.markdown(f"*{opt['explanation']}*")
-                    st.markdown("---")
-                
-                # Create and display summary table
-                st.subheader("🔹 Summary:")
-                
-                summary_data = []
-                for opt in analysis["optimizations"]:
-                    summary_data.append({
-                        "Type of Change": opt["type"],
-                        "Line Number": opt["line_number"],
-                        "Original Code Snippet": opt["existing_logic"],
-                        "Optimized Code Snippet": opt["optimized_logic"],
-                        "Optimization Explanation": opt["explanation"]
-                    })
-                
-                summary_df = pd.DataFrame(summary_data)
-                
-                # Display as a formatted table with custom styling
-                st.markdown("""
-                <style>
-                .summary-table {
-                    font-size: 0.85rem;
-                    border-collapse: collapse;
-                    width: 100%;
-                }
-                .summary-table th {
-                    background-color: #f2f2f2;
-                    text-align: left;
-                    padding: 8px;
-                    border: 1px solid #ddd;
-                }
-                .summary-table td {
-                    text-align: left;
-                    padding: 8px;
-                    border: 1px solid #ddd;
-                }
-                .summary-table tr:nth-child(even) {
-                    background-color: #f9f9f9;
-                }
-                </style>
-                """, unsafe_allow_html=True)
-                
-                # Convert dataframe to HTML table with custom classes
-                table_html = summary_df.to_html(classes='summary-table', escape=False, index=False)
-                st.markdown(table_html, unsafe_allow_html=True)
-            
-            with tab2:
-                # Create Word document
-                with st.spinner("Generating Word document..."):
-                    docx_bytes = create_word_document(analysis)
-                
-                # Provide download button for DOCX
-                st.download_button(
-                    label="⬇️ Download Report as Word Document",
-                    data=docx_bytes,
-                    file_name=f"{analysis['procedure_name']}_analysis.docx",
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    key='docx-download'
-                )
-                
-                # Also provide markdown option
-                report_md = f"""# SQL Stored Procedure Analysis Report
-
-## Procedure Name: {analysis['procedure_name']}
-
-## Scope:
-{analysis['scope']}
-
-## Optimization Steps:
-"""
-                
-                for i, opt in enumerate(analysis["optimizations"], 1):
-                    report_md += f"""
-                    ### Step {i}: {opt['type']}
-
-                    **Existing Logic:**
-                    ```sql
-                    {opt['existing_logic']}
-                    ```
-
-                    **Optimized Logic:**
-                    ```sql
-                    {opt['optimized_logic']}
-                    ```
-
-                    *{opt['explanation']}*
-
-                ---
-                """
-                
-                report_md += "\n## Summary Table:\n\n"
-                report_md += summary_df.to_markdown(index=False)
-                
-                st.download_button(
-                    label="⬇️ Download Report as Markdown",
-                    data=report_md,
-                    file_name=f"{analysis['procedure_name']}_analysis.md",
-                    mime="text/markdown",
-                    key='md-download'
-                )
-                
-                st.info("The Word document (.docx) contains the same content as shown in the 'Analysis' tab, but in a properly formatted document for sharing.")
-        else:
-            st.error("Analysis could not be completed. Please check the Debug section in the sidebar for more details.")
+        if not st.session_state['analysis']:
+            st.error("Analysis could not be completed. Set DEBUG = true in .streamlit/secrets.toml to see the details in the sidebar.")
+
+    # Keep showing the last analysis across reruns, e.g. after a download click
+    analysis = st.session_state.get('analysis')
+    if analysis:
+        _render_analysis(analysis, 'single')
 
 else:
     # Show example when no file is uploaded
@@ -609,35 +916,7 @@ else:
             "Optimization Explanation": "Improves performance by speeding up lookups and joins."
         }]
         
-        example_df = pd.DataFrame(example_data)
-        
-        # Display example table with styling
-        st.markdown("""
-        <style>
-        .summary-table {
-            font-size: 0.85rem;
-            border-collapse: collapse;
-            width: 100%;
-        }
-        .summary-table th {
-            background-color: #f2f2f2;
-            text-align: left;
-            padding: 8px;
-            border: 1px solid #ddd;
-        }
-        .summary-table td {
-            text-align: left;
-            padding: 8px;
-            border: 1px solid #ddd;
-        }
-        .summary-table tr:nth-child(even) {
-            background-color: #f9f9f9;
-        }
-        </style>
-        """, unsafe_allow_html=True)
-        
-        table_html = example_df.to_html(classes='summary-table', escape=False, index=False)
-        st.markdown(table_html, unsafe_allow_html=True)
+        st.dataframe(example_data, hide_index=True, column_config=_SUMMARY_COLUMN_CONFIG)
 
 # Add footer
 st.markdown("---")
@@ -0,0 +1,295 @@
+# Word and Markdown report builders for the SQL Stored Procedure Analyzer.
+# Kept out of the Streamlit script so the templates and helpers below are built once per
+# process on import, rather than re-executed on every rerun of the page.
+import functools
+import tempfile
+from io import BytesIO
+# python-docx is imported inside the functions that use it, so importing this module
+# stays cheap until the first report is built
+
+# Summary table layout; widths in twips: 1.2", 0.8" (line number), 1.5", 1.5", 2.0" (explanation)
+SUMMARY_HEADERS = ['Type of Change', 'Line Number', 'Original Code Snippet', 'Optimized Code Snippet', 'Optimization Explanation']
+_SUMMARY_WIDTHS = [1728, 1152, 2160, 2160, 2880]
+
+# One tuple per optimization, in SUMMARY_HEADERS order; shared by both reports and the
+# on-screen summary
+def summary_rows(optimizations):
+    return [
+        (opt["type"], opt["line_number"], opt["existing_logic"], opt["optimized_logic"], opt["explanation"])
+        for opt in optimizations
+    ]
+
+# Fixed OOXML fragments for the summary table, rendered once instead of per row/cell
+_SUMMARY_TABLE_HEAD = (
+    '<w:tbl xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+    '<w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:w="0" w:type="auto"/>'
+    '<w:tblLook w:val="04A0" w:firstRow="1" w:lastRow="0" w:firstColumn="1" w:lastColumn="0" w:noHBand="0" w:noVBand="1"/>'
+    '</w:tblPr><w:tblGrid>'
+    + ''.join(f'<w:gridCol w:w="{width}"/>' for width in _SUMMARY_WIDTHS)
+    + '</w:tblGrid><w:tr>'
+    + ''.join(
+        f'<w:tc><w:tcPr><w:tcW w:w="{width}" w:type="dxa"/></w:tcPr>'
+        f'<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/></w:rPr><w:t>{header_text}</w:t></w:r></w:p></w:tc>'
+        for header_text, width in zip(SUMMARY_HEADERS, _SUMMARY_WIDTHS)
+    )
+    + '</w:tr>'
+)
+_SHD_F2 = '<w:shd w:val="clear" w:color="auto" w:fill="F2F2F2"/>'
+_CODE_SMALL_PPR = '<w:pPr><w:pStyle w:val="CodeSmall"/></w:pPr>'
+# One data row: {0}-{4} take the escaped cell texts; the code snippet columns use the
+# small monospaced CodeSmall style. Pre-rendered plain and shaded variants, so the
+# alternate-row fill is picked per row rather than added per cell.
+def _summary_row_template(shading):
+    return (
+        '<w:tr>'
+        + ''.join(
+            f'<w:tc><w:tcPr><w:tcW w:w="{width}" w:type="dxa"/>{shading}</w:tcPr>'
+            f'<w:p>{_CODE_SMALL_PPR if col in (2, 3) else ""}<w:r><w:t xml:space="preserve">{{{col}}}</w:t></w:r></w:p></w:tc>'
+            for col, width in enumerate(_SUMMARY_WIDTHS)
+        )
+        + '</w:tr>'
+    )
+
+_ROW_PLAIN = _summary_row_template('')
+_ROW_SHADED = _summary_row_template(_SHD_F2)
+
+# XML-escapes text for a <w:t> element in one C-level pass; line breaks and tabs become
+# their own run elements, as python-docx does when assigning .text
+_DOCX_TEXT_ESC = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '\n': '</w:t><w:br/><w:t xml:space="preserve">',
+    '\r': '</w:t><w:br/><w:t xml:space="preserve">',
+    '\t': '</w:t><w:tab/><w:t xml:space="preserve">'
+})
+
+def _docx_text(text):
+    return str(text).replace('\r\n', '\n').translate(_DOCX_TEXT_ESC)
+
+# Summary-table snippets are cut to this many characters
+_SNIPPET_CHARS = 40
+
+def _snippet(text):
+    return text[:_SNIPPET_CHARS] + "..." if len(text) > _SNIPPET_CHARS else text
+
+# One optimization step of the narrative: heading, the two code blocks in the CodeBlock
+# style, the italic explanation and the underscore separator.
+# {0}-{3} take the escaped step title, existing logic, optimized logic and explanation.
+_CODE_BLOCK_PPR = '<w:pPr><w:pStyle w:val="CodeBlock"/></w:pPr>'
+_STEP_TEMPLATE = (
+    '<w:p><w:pPr><w:pStyle w:val="Heading2"/></w:pPr><w:r><w:t xml:space="preserve">{0}</w:t></w:r></w:p>'
+    '<w:p><w:pPr><w:pStyle w:val="Heading3"/></w:pPr><w:r><w:t>Existing Logic:</w:t></w:r></w:p>'
+    f'<w:p>{_CODE_BLOCK_PPR}<w:r><w:t xml:space="preserve">{{1}}</w:t></w:r></w:p>'
+    '<w:p><w:pPr><w:pStyle w:val="Heading3"/></w:pPr><w:r><w:t>Optimized Logic:</w:t></w:r></w:p>'
+    f'<w:p>{_CODE_BLOCK_PPR}<w:r><w:t xml:space="preserve">{{2}}</w:t></w:r></w:p>'
+    '<w:p><w:r><w:rPr><w:i/></w:rPr><w:t xml:space="preserve">{3}</w:t></w:r></w:p>'
+    f'<w:p><w:r><w:t>{"_" * 40}</w:t></w:r></w:p>'
+)
+_W_BODY_OPEN = '<w:body xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+
+# Render row tuples as a pipe-delimited Markdown table; pipes are escaped and line
+# breaks become <br> so multi-line code snippets stay inside their cell
+def _to_md_table(rows, cols):
+    def cell(value):
+        return str(value).replace('|', '\\|').replace('\r\n', '\n').replace('\n', '<br>')
+
+    lines = ['| ' + ' | '.join(cols) + ' |', '|' + '---|' * len(cols)]
+    lines.extend('| ' + ' | '.join(cell(value) for value in row) + ' |' for row in rows)
+    return '\n'.join(lines) + '\n'
+
+# Serialized reports stay in memory up to this size and spill to a temporary file beyond it
+_REPORT_SPOOL_BYTES = 2 * 1024 * 1024
+
+# python-docx zips the package at the default DEFLATE level (6); level 1 serializes several
+# times faster and the XML parts still compress well. Patched once, on first document.
+def _use_fast_docx_compression():
+    from docx.opc.phys_pkg import _ZipPkgWriter
+
+    if getattr(_ZipPkgWriter, '_fast_deflate', False):
+        return
+    original_init = _ZipPkgWriter.__init__
+
+    def __init__(self, pkg_file):
+        original_init(self, pkg_file)
+        self._zipf.compresslevel = 1
+
+    _ZipPkgWriter.__init__ = __init__
+    _ZipPkgWriter._fast_deflate = True
+
+# Styles the report uses; everything they are based on, link to or continue with is kept too
+_REPORT_STYLES = ('Title', 'Heading1', 'Heading2', 'Heading3', 'TableGrid')
+
+# python-docx's default template carries ~160 style definitions plus a 430 KB
+# stylesWithEffects part and a thumbnail, all parsed on load and re-serialized on save.
+# Strip it down to the report's styles (adding CodeBlock for the step snippets and
+# CodeSmall for the table snippets) once per process, and start every report from the
+# small template instead.
+@functools.lru_cache(maxsize=None)
+def _docx_template():
+    from docx import Document
+    from docx.shared import Pt, Inches
+    from docx.enum.style import WD_STYLE_TYPE
+    from docx.oxml.ns import qn
+
+    doc = Document()
+    styles = doc.styles.element
+    by_id = {style.get(qn('w:styleId')): style for style in styles.iterchildren(qn('w:style'))}
+
+    keep = set(_REPORT_STYLES)
+    keep.update(style_id for style_id, style in by_id.items() if style.get(qn('w:default')) == '1')
+    pending = list(keep)
+    while pending:
+        style = by_id.get(pending.pop())
+        if style is None:
+            continue
+        for tag in ('w:basedOn', 'w:link', 'w:next'):
+            ref = style.find(qn(tag))
+            if ref is not None and ref.get(qn('w:val')) not in keep:
+                keep.add(ref.get(qn('w:val')))
+                pending.append(ref.get(qn('w:val')))
+
+    for style_id, style in by_id.items():
+        if style_id not in keep:
+            styles.remove(style)
+    latent_styles = styles.find(qn('w:latentStyles'))
+    if latent_styles is not None:
+        styles.remove(latent_styles)
+
+    for rels in (doc.part.rels, doc.part.package.rels):
+        for rId, rel in list(rels.items()):
+            if rel.reltype.endswith(('/stylesWithEffects', '/thumbnail')):
+                del rels[rId]
+
+    # Paragraph styles for the code blocks and the table's code cells, instead of
+    # formatting every run
+    code_block = doc.styles.add_style('CodeBlock', WD_STYLE_TYPE.PARAGRAPH)
+    code_block.font.name = 'Courier New'
+    code_block.font.size = Pt(10)
+    code_block.paragraph_format.left_indent = Inches(0.25)
+    code_block.paragraph_format.right_indent = Inches(0.25)
+
+    code_small = doc.styles.add_style('CodeSmall', WD_STYLE_TYPE.PARAGRAPH)
+    code_small.font.name = 'Courier New'
+    code_small.font.size = Pt(9)
+
+    template = BytesIO()
+    doc.save(template)
+    return template.getvalue()
+
+# Function to create a Word document from analysis
+def create_word_document(analysis):
+    from docx import Document
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.oxml import parse_xml
+
+    # Create a new Document from the stripped-down template
+    doc = Document(BytesIO(_docx_template()))
+
+    # Add title
+    title = doc.add_heading('SQL Stored Procedure Analysis Report', 0)
+    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+
+    # Add procedure name
+    proc_name_heading = doc.add_heading('Stored Procedure Name:', level=1)
+    # Make the procedure name itself bold in its own paragraph
+    proc_name_para = doc.add_paragraph()
+    proc_name_para.add_run(analysis['procedure_name']).bold = True
+
+    # Add scope
+    doc.add_heading('Scope:', level=1)
+    doc.add_paragraph(analysis['scope'])
+
+    # Add optimization steps
+    doc.add_heading('Optimization Steps:', level=1)
+
+    # Walk the optimizations once, rendering each step's paragraphs and its summary row
+    # as XML strings; each part is parsed once, instead of ~8 python-docx calls per step
+    steps = [_W_BODY_OPEN]
+    rows = [_SUMMARY_TABLE_HEAD]
+    for i, (opt_type, line_number, existing_logic, optimized_logic, explanation) in enumerate(summary_rows(analysis["optimizations"]), 1):
+        opt_type = _docx_text(opt_type)
+        explanation = _docx_text(explanation)
+
+        steps.append(_STEP_TEMPLATE.format(
+            f'Step {i}: {opt_type}',
+            _docx_text(existing_logic),
+            _docx_text(optimized_logic),
+            explanation
+        ))
+
+        # Summary row with the snippets cut short; every second data row gets a light
+        # gray fill
+        row_template = _ROW_PLAIN if i & 1 else _ROW_SHADED
+        rows.append(row_template.format(
+            opt_type,
+            _docx_text(line_number),
+            _docx_text(_snippet(existing_logic)),
+            _docx_text(_snippet(optimized_logic)),
+            explanation
+        ))
+    steps.append('</w:body>')
+    rows.append('</w:tbl>')
+
+    # Move the parsed paragraphs in ahead of the section properties, which must stay last
+    sect_pr = doc.element.body.sectPr
+    for paragraph in list(parse_xml(''.join(steps))):
+        sect_pr.addprevious(paragraph)
+
+    # Add summary table
+    doc.add_heading('Summary:', level=1)
+
+    # Add table to document only if there's data
+    if analysis["optimizations"]:
+        # Going through python-docx's per-cell proxies is far slower for tables with
+        # long code snippets
+        doc.element.body._insert_tbl(parse_xml(''.join(rows)))
+    else:
+        doc.add_paragraph("No optimization suggestions were generated.")
+
+
+    _use_fast_docx_compression()
+
+    # Small documents stay in memory; large ones spill to disk instead of holding the
+    # serialized zip in memory next to the document tree. The file is deleted on close.
+    doc_io = tempfile.SpooledTemporaryFile(max_size=_REPORT_SPOOL_BYTES)
+    doc.save(doc_io)
+    doc_io.seek(0)
+
+    return doc_io
+
+# Function to create a Markdown report from analysis
+def create_markdown_report(analysis):
+    # Collect the pieces and join once
+    md_parts = [f"""# SQL Stored Procedure Analysis Report
+
+## Procedure Name: {analysis['procedure_name']}
+
+## Scope:
+{analysis['scope']}
+
+## Optimization Steps:
+"""]
+
+    # Steps start at column 0: indented lines would render as code blocks
+    md_parts.extend(f"""
+### Step {i}: {opt['type']}
+
+**Existing Logic:**
+```sql
+{opt['existing_logic']}
+```
+
+**Optimized Logic:**
+```sql
+{opt['optimized_logic']}
+```
+
+*{opt['explanation']}*
+
+---
+""" for i, opt in enumerate(analysis["optimizations"], 1))
+
+    md_parts.append("\n## Summary Table:\n\n")
+    md_parts.append(_to_md_table(summary_rows(analysis["optimizations"]), SUMMARY_HEADERS))
+    return "".join(md_parts)